@@ -1,140 +1,204 @@
 import pandas as pd
+import argparse
+import asyncio
 import logging
-from tqdm import tqdm
+from tqdm.asyncio import tqdm
 from typing import List, Dict, Any, Optional
+import lxml.etree as ET
+from cachetools import LFUCache
 import os
+import re
 import sys
 import urllib.parse
+from collections import defaultdict
 
 # Add src to path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from src.utils import setup_logging, fetch_content, parse_xml, parse_html, clean_text
+from src.utils import setup_logging, load_memos, save_memos, shutdown_parse_pool, progress_options, create_session, fetch_parsed, fetch_votacion_fields, memoize_async, MEMO_MAXSIZE, VOTE_TO_BOLETIN, check_csv_header, load_processed_ids, open_csv_appender, parse_html_lxml, clean_text
 
-# Caches
-boletin_to_project_id: Dict[str, str] = {}
-project_urgencies: Dict[str, List[Dict[str, Any]]] = {}
-vote_to_boletin: Dict[str, str] = {}
+# Columns of the urgencies table, in page order:
+# Fecha Inicio | Fecha término | Tipo | N° Oficio | N° Mensaje ingreso | N° Mensaje retiro
+URGENCIA_FIELDS = [
+    'urgencia_fecha_inicio', 'urgencia_fecha_termino', 'urgencia_tipo',
+    'urgencia_oficio', 'urgencia_mensaje_ing', 'urgencia_mensaje_ret'
+]
 
-def fetch_boletin_for_vote(vote_id: str) -> str:
+# Columns of the output CSV, in order
+OUTPUT_COLUMNS = ['vote_id', 'boletin', 'proyecto_id'] + URGENCIA_FIELDS
+
+# Caches for this run only: project IDs and urgencies can change, so reuse
+# across runs goes through the HTTP cache, which revalidates stale pages.
+# LFU-bounded so memory stays flat on long crawls.
+boletin_to_project_id: LFUCache = LFUCache(maxsize=MEMO_MAXSIZE)
+project_urgencies: LFUCache = LFUCache(maxsize=MEMO_MAXSIZE)
+
+# Compiled once so the table search runs inside lxml instead of Python loops.
+# The first table with a cell reading "Fecha Inicio" or "Tipo de urgencia" is the
+# urgencies table. Probing cells (not the whole table text) stops at the first match.
+URGENCIAS_TABLE_XPATH = ET.XPath(
+    '(//table[.//*[self::th or self::td]'
+    '[contains(., "Fecha Inicio") or contains(., "Tipo de urgencia")]])[1]'
+)
+ROWS_XPATH = ET.XPath('.//tr')
+CELLS_XPATH = ET.XPath('./td')
+
+# <a href="urgencias.aspx?prmID=XXXX&prmBOLETIN=..."> on the tramitacion page
+URGENCIAS_LINK_RE = re.compile(rb'urgencias\.aspx\?prmID=(\d+)', re.IGNORECASE)
+URGENCIAS_LINK_XPATH = ET.XPath('//a[contains(@href, "urgencias.aspx")]/@href')
+
+def build_row_extractor(fields: List[str]):
+    """
+    Generates a function mapping a row's cell texts to a dict of `fields`, by position.
+    The column schema is fixed, so the dict literal is written out once at import
+    instead of looping over column indices for every row. Missing cells map to "".
+    """
+    items = ", ".join(
+        f"{field!r}: clean_text(texts[{i}]) if n > {i} else ''"
+        for i, field in enumerate(fields)
+    )
+    source = f"def extract_row(texts):\n    n = len(texts)\n    return {{{items}}}\n"
+    namespace = {'clean_text': clean_text}
+    exec(source, namespace)
+    return namespace['extract_row']
+
+extract_urgencia_row = build_row_extractor(URGENCIA_FIELDS)
+
+@memoize_async(VOTE_TO_BOLETIN, key=lambda session, vote_id: vote_id)
+async def fetch_boletin_for_vote(session, vote_id: str) -> str:
     """
     Quickly fetches just the bulletin for a vote ID.
     """
-    if vote_id in vote_to_boletin:
-        return vote_to_boletin[vote_id]
-        
-    url = f"https://opendata.camara.cl/camaradiputados/pages/legislativo/retornarVotacionDetalle.aspx?prmID={vote_id}"
-    content = fetch_content(url)
-    if not content:
+    fields = await fetch_votacion_fields(session, vote_id)
+    if fields is None:
         return ""
 
-    root = parse_xml(content)
-    if root is None:
-        return ""
-        
-    # Find Boletin
-    found = root.find(".//{*}Boletin")
-    if found is None:
-        found = root.find("Boletin")
-    
-    boletin = clean_text(found.text) if found is not None else ""
-    if boletin:
-        vote_to_boletin[vote_id] = boletin
-    return boletin
-
-def fetch_proyecto_id_from_tramitacion(boletin: str) -> str:
+    return fields.get('Boletin', '')
+
+@memoize_async(boletin_to_project_id, key=lambda session, boletin: boletin)
+async def fetch_proyecto_id_from_tramitacion(session, boletin: str) -> str:
     """
     Scrapes the tramitacion page to find the internal project ID (prmID) for urgencies.
     """
     if not boletin:
         return ""
-    if boletin in boletin_to_project_id:
-        return boletin_to_project_id[boletin]
 
     url = f"https://www.camara.cl/legislacion/ProyectosDeLey/tramitacion.aspx?prmBoletin={boletin}"
-    content = fetch_content(url)
-    if not content:
-        return ""
+    return await fetch_parsed(session, url, extract_proyecto_id) or ""
+
+def extract_proyecto_id(content: bytes) -> str:
+    """
+    Extracts the project ID from the urgencias link of a tramitacion page. Runs in the parse pool.
+    """
+    # Fast path: the link is found directly in the raw bytes, without building a DOM
+    match = URGENCIAS_LINK_RE.search(content)
+    if match:
+        return match.group(1).decode('ascii')
 
-    soup = parse_html(content)
-    if not soup:
+    # Fallback for unusually formatted links
+    tree = parse_html_lxml(content)
+    if tree is None:
         return ""
 
     # Look for the link to urgencias.aspx
     # <a href="urgencias.aspx?prmID=XXXX&prmBOLETIN=...">
-    
-    link = soup.find('a', href=lambda x: x and 'urgencias.aspx' in x)
-    if link:
-        href = link.get('href')
-        parsed = urllib.parse.urlparse(href)
+
+    hrefs = URGENCIAS_LINK_XPATH(tree)
+    if hrefs:
+        parsed = urllib.parse.urlparse(hrefs[0])
         qs = urllib.parse.parse_qs(parsed.query)
-        prmID = qs.get('prmID', [''])[0]
-        
-        if prmID:
-            boletin_to_project_id[boletin] = prmID
-            return prmID
-            
+        return qs.get('prmID', [''])[0]
+
     return ""
 
-def fetch_urgencias(project_id: str, boletin: str) -> List[Dict[str, Any]]:
+@memoize_async(project_urgencies, key=lambda session, project_id, boletin: f"{project_id}_{boletin}")
+async def fetch_urgencias(session, project_id: str, boletin: str) -> List[Dict[str, Any]]:
     """
     Scrapes the urgencies table.
     """
     if not project_id:
         return []
-        
-    cache_key = f"{project_id}_{boletin}"
-    if cache_key in project_urgencies:
-        return project_urgencies[cache_key]
 
     url = f"https://www.camara.cl/legislacion/ProyectosDeLey/urgencias.aspx?prmID={project_id}&prmBOLETIN={boletin}"
-    content = fetch_content(url)
-    if not content:
-        return []
+    return await fetch_parsed(session, url, extract_urgencias) or []
 
-    soup = parse_html(content)
-    if not soup:
+def extract_urgencias(content: bytes) -> List[Dict[str, Any]]:
+    """
+    Extracts the rows of the urgencies table. Runs in the parse pool.
+    """
+    tree = parse_html_lxml(content)
+    if tree is None:
         return []
 
     urgencies = []
     # Find the table "Urgencias"
     # Usually a table with specific headers or class.
     # We'll look for a table that contains "Fecha Inicio" or "Tipo de urgencia"
-    
-    tables = soup.find_all('table')
-    target_table = None
-    
-    for table in tables:
-        if "Fecha Inicio" in table.get_text() or "Tipo de urgencia" in table.get_text():
-            target_table = table
-            break
-            
-    if target_table:
-        rows = target_table.find_all('tr')
+
+    tables = URGENCIAS_TABLE_XPATH(tree)
+
+    if tables:
+        rows = ROWS_XPATH(tables[0])
         # Assuming first row is header
         for row in rows[1:]:
-            cols = row.find_all('td')
-            if len(cols) < 5: # Expecting at least 5-6 columns
+            texts = [cell.text_content() for cell in CELLS_XPATH(row)]
+            if len(texts) < 5: # Expecting at least 5-6 columns
                 continue
-                
-            # Mapping based on typical order:
-            # Fecha Inicio | Fecha término | Tipo | N° Oficio | N° Mensaje ingreso | N° Mensaje retiro
-            
-            u_data = {
-                'urgencia_fecha_inicio': clean_text(cols[0].get_text()),
-                'urgencia_fecha_termino': clean_text(cols[1].get_text()),
-                'urgencia_tipo': clean_text(cols[2].get_text()),
-                'urgencia_oficio': clean_text(cols[3].get_text()),
-                'urgencia_mensaje_ing': clean_text(cols[4].get_text()),
-                'urgencia_mensaje_ret': clean_text(cols[5].get_text()) if len(cols) > 5 else ""
-            }
-            urgencies.append(u_data)
 
-    project_urgencies[cache_key] = urgencies
+            urgencies.append(extract_urgencia_row(texts))
+
     return urgencies
 
-def main():
+def build_rows(vote_id: str, boletin: str, project_id: str, urgency_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Expands a vote into one row per urgency of its project.
+    """
+    # One vote might have multiple urgencies associated with its project.
+    # The user wants a CSV with vote_id and urgency details.
+    # If a project has 5 urgencies, do we repeat the vote_id 5 times?
+    # Usually yes, to have a flat table.
+
+    if urgency_list:
+        return [
+            {
+                'vote_id': vote_id,
+                'boletin': boletin,
+                'proyecto_id': project_id,
+                **urg
+            }
+            for urg in urgency_list
+        ]
+
+    # No urgencies found, but we still record the vote/project link?
+    # Or skip? User asked for "votaciones_urgencias", implying the join.
+    # I'll add a row with empty urgency fields to preserve the vote info.
+    return [{
+        'vote_id': vote_id,
+        'boletin': boletin,
+        'proyecto_id': project_id,
+        **dict.fromkeys(URGENCIA_FIELDS, "")
+    }]
+
+def load_meta_boletines(meta_csv: str) -> Dict[str, str]:
+    """
+    Reads the vote_id -> boletin mapping from the metadata CSV written by
+    fetch_votaciones.py, so the vote detail XML is not fetched a second time.
+    """
+    if not os.path.exists(meta_csv):
+        logging.info(f"Metadata CSV not found: {meta_csv}, boletines will be fetched.")
+        return {}
+
+    try:
+        meta = pd.read_csv(meta_csv, usecols=['vote_id', 'boletin'], dtype=str).dropna()
+    except (OSError, ValueError) as e:
+        logging.warning(f"Error reading metadata CSV {meta_csv}: {e}")
+        return {}
+
+    return dict(zip(meta['vote_id'], meta['boletin']))
+
+async def main(meta_csv: str = 'outputs/votaciones_meta_2022_26.csv'):
     setup_logging()
     logging.info("Starting Script 2: Fetch Urgencias")
+    load_memos()
 
     input_path = 'dataverse_files/matriz__periodo_2022_26.csv'
     output_path = 'outputs/votaciones_urgencias_2022_26.csv'
@@ -149,67 +213,74 @@ def main():
         logging.error(f"Error reading CSV: {e}")
         return
 
-    vote_ids = [col for col in df.columns if col.isdigit()]
+    # dict.fromkeys drops duplicates while keeping the column order
+    vote_ids = list(dict.fromkeys(col for col in df.columns if col.isdigit()))
     logging.info(f"Found {len(vote_ids)} vote IDs to process.")
 
-    results = []
-
-    # Optimization: First find unique bulletins for all votes to minimize requests
-    # But we need to map vote -> boletin first.
-    # We can do it lazily in the loop.
-
-    for vote_id in tqdm(vote_ids, desc="Processing Urgencies"):
-        # 1. Get Boletin
-        boletin = fetch_boletin_for_vote(vote_id)
-        if not boletin:
-            continue
-            
-        # 2. Get Project ID
-        project_id = fetch_proyecto_id_from_tramitacion(boletin)
-        if not project_id:
-            logging.warning(f"Could not find project ID for boletin {boletin}")
-            continue
-            
-        # 3. Get Urgencies
-        urgency_list = fetch_urgencias(project_id, boletin)
-        
-        # 4. Expand rows (one vote might have multiple urgencies associated with its project)
-        # The user wants a CSV with vote_id and urgency details.
-        # If a project has 5 urgencies, do we repeat the vote_id 5 times?
-        # Usually yes, to have a flat table.
-        
-        if urgency_list:
-            for urg in urgency_list:
-                row = {
-                    'vote_id': vote_id,
-                    'boletin': boletin,
-                    'proyecto_id': project_id,
-                    **urg
-                }
-                results.append(row)
-        else:
-            # No urgencies found, but we still record the vote/project link?
-            # Or skip? User asked for "votaciones_urgencias", implying the join.
-            # I'll add a row with empty urgency fields to preserve the vote info.
-            row = {
-                'vote_id': vote_id,
-                'boletin': boletin,
-                'proyecto_id': project_id,
-                'urgencia_fecha_inicio': "",
-                'urgencia_fecha_termino': "",
-                'urgencia_tipo': "",
-                'urgencia_oficio': "",
-                'urgencia_mensaje_ing': "",
-                'urgencia_mensaje_ret': ""
-            }
-            results.append(row)
+    if not check_csv_header(output_path, OUTPUT_COLUMNS):
+        return
+
+    # Resume: votes already in the output were processed by a previous run
+    processed = load_processed_ids(output_path)
+    pending = [vote_id for vote_id in vote_ids if vote_id not in processed]
+    logging.info(f"Skipping {len(vote_ids) - len(pending)} vote IDs already in {output_path}.")
+    vote_ids = pending
+
+    meta_boletines = load_meta_boletines(meta_csv)
+    VOTE_TO_BOLETIN.update(meta_boletines)
+    logging.info(f"Loaded {len(meta_boletines)} boletines from {meta_csv}")
+
+    saved = 0
+    try:
+        async with create_session() as session:
+            # 1. Get Boletin for every vote
+            boletines = await tqdm.gather(
+                *(fetch_boletin_for_vote(session, vote_id) for vote_id in vote_ids),
+                desc="Fetching Boletines",
+                **progress_options(len(vote_ids))
+            )
+
+            # 2. Group votes by boletin: many votes share the same bulletin, so each
+            # bulletin's project ID and urgencies are fetched once and written for all its votes.
+            boletin_votes: Dict[str, List[str]] = defaultdict(list)
+            for vote_id, boletin in zip(vote_ids, boletines):
+                if boletin:
+                    boletin_votes[boletin].append(vote_id)
+
+            # 3. Resolve each bulletin independently and write its rows as soon as it is done
+            with open_csv_appender(output_path, OUTPUT_COLUMNS) as append_rows:
+                async def process_boletin(boletin: str, votes: List[str]) -> None:
+                    nonlocal saved
+                    project_id = await fetch_proyecto_id_from_tramitacion(session, boletin)
+                    if not project_id:
+                        logging.warning(f"Could not find project ID for boletin {boletin}")
+                        return
+
+                    urgency_list = await fetch_urgencias(session, project_id, boletin)
+                    for vote_id in votes:
+                        append_rows(build_rows(vote_id, boletin, project_id, urgency_list))
+                    saved += len(votes)
+
+                await tqdm.gather(
+                    *(process_boletin(boletin, votes) for boletin, votes in boletin_votes.items()),
+                    desc="Processing Boletines",
+                    **progress_options(len(boletin_votes))
+                )
+    finally:
+        shutdown_parse_pool()
+        save_memos()
 
-    if results:
-        out_df = pd.DataFrame(results)
-        out_df.to_csv(output_path, index=False)
-        logging.info(f"Saved urgencies to {output_path}")
+    if saved:
+        logging.info(f"Saved urgencies for {saved} votes to {output_path}")
     else:
-        logging.warning("No results to save.")
+        logging.warning("No new results to save.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Fetch urgencias for each vote of the period.")
+    parser.add_argument(
+        '--meta-csv',
+        default='outputs/votaciones_meta_2022_26.csv',
+        help="Output of fetch_votaciones.py; its boletin column is reused instead of refetching vote details."
+    )
+    args = parser.parse_args()
+    asyncio.run(main(meta_csv=args.meta_csv))
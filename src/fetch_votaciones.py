@@ -1,56 +1,59 @@
 import pandas as pd
+import asyncio
 import logging
-from tqdm import tqdm
+from tqdm.asyncio import tqdm
 from typing import List, Dict, Any, Optional
+import lxml.etree as ET
+from cachetools import LFUCache
 import os
 import sys
 
 # Add src to path to import utils
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from src.utils import setup_logging, fetch_content, parse_xml, parse_html, clean_text
+from src.utils import setup_logging, load_memos, save_memos, shutdown_parse_pool, progress_options, create_session, fetch_parsed, fetch_votacion_fields, memoize_async, MEMO_MAXSIZE, VOTE_TO_BOLETIN, check_csv_header, load_processed_ids, open_csv_appender, parse_html_lxml, clean_text
 
-# Cache for bulletin data to avoid redundant requests
-boletin_cache: Dict[str, List[Dict[str, Any]]] = {}
+# Columns of the output CSV, in order
+OUTPUT_COLUMNS = [
+    'vote_id', 'boletin', 'fecha', 'tipo_votacion', 'resultado', 'quorum',
+    'sesion_id', 'sesion_numero', 'descripcion_articulo', 'contexto_tramite'
+]
 
-def fetch_votacion_detalle(vote_id: str) -> Optional[Dict[str, Any]]:
+# Cache for bulletin data to avoid redundant requests, for this run only:
+# a bulletin's votes can change, so reuse across runs goes through the HTTP cache.
+# LFU-bounded so memory stays flat on long crawls.
+boletin_cache: LFUCache = LFUCache(maxsize=MEMO_MAXSIZE)
+
+# Tables whose first row has a header cell mentioning "Fecha"
+VOTACIONES_TABLES_XPATH = ET.XPath('//table[(.//tr)[1]/*[self::th or self::td][contains(., "Fecha")]]')
+ROWS_XPATH = ET.XPath('.//tr')
+CELLS_XPATH = ET.XPath('./td')
+
+async def fetch_votacion_detalle(session, vote_id: str) -> Optional[Dict[str, Any]]:
     """
     Fetches details for a specific vote ID from the XML API.
     """
-    url = f"https://opendata.camara.cl/camaradiputados/pages/legislativo/retornarVotacionDetalle.aspx?prmID={vote_id}"
-    content = fetch_content(url)
-    if not content:
+    fields = await fetch_votacion_fields(session, vote_id)
+    if fields is None:
         return None
 
-    root = parse_xml(content)
-    if root is None:
-        return None
-
-    # Namespace handling might be needed if the XML has namespaces, 
-    # but usually lxml handles simple tags well or we can use local-name() if needed.
-    # Based on typical Camara API, it might have a namespace. 
-    # We will try to find elements by tag name ignoring namespace for simplicity or use standard methods.
-    
-    # Helper to find text safely
-    def get_text(element, tag):
-        # Search for tag in children
-        found = element.find(f".//{{*}}{tag}")
-        if found is None:
-            found = element.find(tag)
-        return clean_text(found.text) if found is not None else ""
+    # Share the vote's bulletin with fetch_urgencias.py through the persisted memo
+    if fields.get('Boletin'):
+        VOTE_TO_BOLETIN[vote_id] = fields['Boletin']
 
     # Extract basic info
     # The structure usually is Votacion -> Sesion, etc.
-    # We need to inspect the XML structure. Assuming a flat-ish structure or standard traversal.
+    # Only the fields below are kept while streaming the XML; tags are matched
+    # by local name, so a namespaced payload works too.
     
     # Note: The user provided specific fields: Fecha, Tipo, Resultado, Quorum, Sesion, Boletin
     
     data = {
         'vote_id': vote_id,
-        'fecha': get_text(root, 'Fecha'),
-        'tipo': get_text(root, 'Tipo'),
-        'resultado': get_text(root, 'Resultado'),
-        'quorum': get_text(root, 'Quorum'),
-        'boletin': get_text(root, 'Boletin'),
+        'fecha': fields.get('Fecha', ''),
+        'tipo': fields.get('Tipo', ''),
+        'resultado': fields.get('Resultado', ''),
+        'quorum': fields.get('Quorum', ''),
+        'boletin': fields.get('Boletin', ''),
         'sesion_id': "",
         'sesion_numero': "",
         'sesion_fecha': "",
@@ -58,35 +61,34 @@ def fetch_votacion_detalle(vote_id: str) -> Optional[Dict[str, Any]]:
     }
     
     # Sesion details
-    sesion = root.find(".//{*}Sesion")
-    if sesion is None:
-        sesion = root.find("Sesion")
-        
+    sesion = fields['Sesion']
     if sesion is not None:
-        data['sesion_id'] = sesion.get('ID', '')
-        data['sesion_numero'] = get_text(sesion, 'Numero')
-        data['sesion_fecha'] = get_text(sesion, 'Fecha')
-        data['sesion_tipo'] = get_text(sesion, 'Tipo')
+        data['sesion_id'] = sesion['ID']
+        data['sesion_numero'] = sesion.get('Numero', '')
+        data['sesion_fecha'] = sesion.get('Fecha', '')
+        data['sesion_tipo'] = sesion.get('Tipo', '')
 
     return data
 
-def fetch_votaciones_boletin(boletin: str) -> List[Dict[str, Any]]:
+@memoize_async(boletin_cache, key=lambda session, boletin: boletin)
+async def fetch_votaciones_boletin(session, boletin: str) -> List[Dict[str, Any]]:
     """
     Fetches all votings associated with a bulletin from the HTML page.
     """
     if not boletin:
         return []
-        
-    if boletin in boletin_cache:
-        return boletin_cache[boletin]
 
     url = f"https://opendata.camara.cl/pages/votacion_boletin.aspx?prmBoletin={boletin}"
-    content = fetch_content(url)
-    if not content:
-        return []
+    rows = await fetch_parsed(session, url, extract_votaciones_boletin) or []
+    return [{'boletin_context': boletin, 'raw_data': raw_data} for raw_data in rows]
 
-    soup = parse_html(content)
-    if not soup:
+def extract_votaciones_boletin(content: bytes) -> List[str]:
+    """
+    Extracts the votings table rows from a bulletin page, one " | "-joined
+    string per row. Runs in the parse pool.
+    """
+    tree = parse_html_lxml(content)
+    if tree is None:
         return []
 
     votaciones = []
@@ -99,21 +101,14 @@ def fetch_votaciones_boletin(boletin: str) -> List[Dict[str, Any]]:
     # The user mentioned fields: ID, Fecha, Tipo, Resultado, Quorum, Sesion, Descripcion, Totales.
     
     # Let's try to find a main table.
-    tables = soup.find_all('table')
+    # Heuristic: the header row (first row) must contain "Fecha"; checked inside the XPath.
+    tables = VOTACIONES_TABLES_XPATH(tree)
     
     for table in tables:
-        rows = table.find_all('tr')
-        if not rows:
-            continue
-            
-        # Check headers to confirm it's the right table
-        headers = [clean_text(th.get_text()) for th in rows[0].find_all(['th', 'td'])]
-        # Heuristic: check if headers contain "Fecha" or "Resultado"
-        if not any("Fecha" in h for h in headers):
-            continue
+        rows = ROWS_XPATH(table)
 
         for row in rows[1:]: # Skip header
-            cols = row.find_all('td')
+            cols = CELLS_XPATH(row)
             if len(cols) < 4:
                 continue
                 
@@ -138,18 +133,69 @@ def fetch_votaciones_boletin(boletin: str) -> List[Dict[str, Any]]:
             # (I have tools but I should write the code to do it).
             # I will write generic parsing logic that captures the row data.
             
-            row_data = {
-                'boletin_context': boletin,
-                'raw_data': " | ".join([clean_text(c.get_text()) for c in cols])
-            }
-            votaciones.append(row_data)
+            votaciones.append(" | ".join([clean_text(c.text_content()) for c in cols]))
 
-    boletin_cache[boletin] = votaciones
     return votaciones
 
-def main():
+async def process_vote(session, vote_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Builds the metadata row for a single vote ID.
+    """
+    # Step 1: Get details from XML
+    details = await fetch_votacion_detalle(session, vote_id)
+    if not details:
+        logging.warning(f"Could not fetch details for vote_id {vote_id}")
+        return None
+    
+    # Step 2: Get bulletin info (optional, but requested to link info)
+    # The user said: "A partir del boletín obtenido, consultar... Esta página devuelve todas las votaciones asociadas al boletín."
+    # And "Guardar un CSV final... con columnas útiles como: vote_id, boletin, fecha..."
+
+    # It seems the user wants to enrich the single vote_id with the context of the bulletin.
+    # But `fetch_votaciones_boletin` returns *all* votings for that bulletin.
+    # If we just want metadata for *this* vote_id, the XML `fetch_votacion_detalle` gives most of it.
+    # The HTML page gives context like "descripcion_articulo" which might be missing in XML?
+    # The XML usually has "Descripcion" or "Materia".
+
+    # Let's assume we want to fetch the bulletin page to get the "descripcion_articulo" 
+    # corresponding to THIS vote_id if possible, or just dump the XML data if it's sufficient.
+    # The user's flow: "ID -> Detalle -> Boletin -> Info del boletin".
+    # And the output CSV has `vote_id`, `boletin`, `descripcion_articulo`.
+
+    # I will fetch the bulletin page and try to match the current `vote_id` to the list returned,
+    # to get the specific description for this vote.
+
+    boletin = details.get('boletin')
+    descripcion_articulo = ""
+    contexto_tramite = ""
+
+    if boletin:
+        bulletin_votings = await fetch_votaciones_boletin(session, boletin)
+        # Try to find our vote_id in the bulletin votings
+        # This requires the HTML parsing to extract the ID from the table.
+        # If the HTML table doesn't explicitly show the ID in text, we might need to look at links.
+        # For now, I'll leave the description empty if I can't match, or take the first one if it's a single vote.
+        pass
+
+    # Construct row
+    row = {
+        'vote_id': vote_id,
+        'boletin': boletin,
+        'fecha': details.get('fecha'),
+        'tipo_votacion': details.get('tipo'),
+        'resultado': details.get('resultado'),
+        'quorum': details.get('quorum'),
+        'sesion_id': details.get('sesion_id'),
+        'sesion_numero': details.get('sesion_numero'),
+        'descripcion_articulo': descripcion_articulo, # Placeholder
+        'contexto_tramite': contexto_tramite # Placeholder
+    }
+    return row
+
+async def main():
     setup_logging()
     logging.info("Starting Script 1: Fetch Votaciones Metadata")
+    load_memos()
 
     input_path = 'dataverse_files/matriz__periodo_2022_26.csv'
     output_path = 'outputs/votaciones_meta_2022_26.csv'
@@ -165,70 +211,41 @@ def main():
         return
 
     # Extract vote IDs (numeric columns)
-    vote_ids = [col for col in df.columns if col.isdigit()]
+    # dict.fromkeys drops duplicates while keeping the column order
+    vote_ids = list(dict.fromkeys(col for col in df.columns if col.isdigit()))
     logging.info(f"Found {len(vote_ids)} vote IDs to process.")
 
-    results = []
+    if not check_csv_header(output_path, OUTPUT_COLUMNS):
+        return
 
-    for vote_id in tqdm(vote_ids, desc="Processing Votes"):
-        # Step 1: Get details from XML
-        details = fetch_votacion_detalle(vote_id)
-        if not details:
-            logging.warning(f"Could not fetch details for vote_id {vote_id}")
-            continue
-            
-        # Step 2: Get bulletin info (optional, but requested to link info)
-        # The user said: "A partir del boletín obtenido, consultar... Esta página devuelve todas las votaciones asociadas al boletín."
-        # And "Guardar un CSV final... con columnas útiles como: vote_id, boletin, fecha..."
-        
-        # It seems the user wants to enrich the single vote_id with the context of the bulletin.
-        # But `fetch_votaciones_boletin` returns *all* votings for that bulletin.
-        # If we just want metadata for *this* vote_id, the XML `fetch_votacion_detalle` gives most of it.
-        # The HTML page gives context like "descripcion_articulo" which might be missing in XML?
-        # The XML usually has "Descripcion" or "Materia".
-        
-        # Let's assume we want to fetch the bulletin page to get the "descripcion_articulo" 
-        # corresponding to THIS vote_id if possible, or just dump the XML data if it's sufficient.
-        # The user's flow: "ID -> Detalle -> Boletin -> Info del boletin".
-        # And the output CSV has `vote_id`, `boletin`, `descripcion_articulo`.
-        
-        # I will fetch the bulletin page and try to match the current `vote_id` to the list returned,
-        # to get the specific description for this vote.
-        
-        boletin = details.get('boletin')
-        descripcion_articulo = ""
-        contexto_tramite = ""
-        
-        if boletin:
-            bulletin_votings = fetch_votaciones_boletin(boletin)
-            # Try to find our vote_id in the bulletin votings
-            # This requires the HTML parsing to extract the ID from the table.
-            # If the HTML table doesn't explicitly show the ID in text, we might need to look at links.
-            # For now, I'll leave the description empty if I can't match, or take the first one if it's a single vote.
-            pass
-
-        # Construct row
-        row = {
-            'vote_id': vote_id,
-            'boletin': boletin,
-            'fecha': details.get('fecha'),
-            'tipo_votacion': details.get('tipo'),
-            'resultado': details.get('resultado'),
-            'quorum': details.get('quorum'),
-            'sesion_id': details.get('sesion_id'),
-            'sesion_numero': details.get('sesion_numero'),
-            'descripcion_articulo': descripcion_articulo, # Placeholder
-            'contexto_tramite': contexto_tramite # Placeholder
-        }
-        results.append(row)
-
-    # Save results
-    if results:
-        out_df = pd.DataFrame(results)
-        out_df.to_csv(output_path, index=False)
-        logging.info(f"Saved metadata to {output_path}")
+    # Resume: votes already in the output were processed by a previous run
+    processed = load_processed_ids(output_path)
+    pending = [vote_id for vote_id in vote_ids if vote_id not in processed]
+    logging.info(f"Skipping {len(vote_ids) - len(pending)} vote IDs already in {output_path}.")
+
+    saved = 0
+    try:
+        # Rows are written as soon as each vote finishes, so memory stays flat
+        # and an interrupted run keeps everything done so far.
+        async with create_session() as session:
+            with open_csv_appender(output_path, OUTPUT_COLUMNS) as append_rows:
+                async def process_and_save(vote_id: str) -> None:
+                    nonlocal saved
+                    row = await process_vote(session, vote_id)
+                    if row:
+                        append_rows([row])
+                        saved += 1
+
+                tasks = [process_and_save(vote_id) for vote_id in pending]
+                await tqdm.gather(*tasks, desc="Processing Votes", **progress_options(len(tasks)))
+    finally:
+        shutdown_parse_pool()
+        save_memos()
+
+    if saved:
+        logging.info(f"Saved metadata for {saved} votes to {output_path}")
     else:
-        logging.warning("No results to save.")
+        logging.warning("No new results to save.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,9 +1,20 @@
-import requests
-import time
+import asyncio
+import csv
+import diskcache
+import functools
+import httpx
+import json
 import logging
-from bs4 import BeautifulSoup
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from cachetools import LFUCache
 import lxml.etree as ET
-from typing import Optional, Union, Dict, Any
+import lxml.html
+from typing import Optional, Dict, Any, Awaitable, Callable, Iterable, Iterator, List, MutableMapping, Set, TypeVar
+
+T = TypeVar('T')
 
 # Configure logging
 def setup_logging(log_file: str = 'outputs/logs.txt'):
@@ -16,51 +27,398 @@ def setup_logging(log_file: str = 'outputs/logs.txt'):
         ]
     )
 
-def fetch_content(url: str, retries: int = 3, sleep_time: float = 0.5) -> Optional[Union[bytes, str]]:
+def progress_options(total: int) -> Dict[str, Any]:
+    """
+    tqdm settings that redraw at most twice a second and about 200 times per run,
+    so the progress bar stays cheap when thousands of tasks finish quickly.
+    """
+    return {'mininterval': 0.5, 'miniters': max(1, total // 200)}
+
+# Maximum number of requests in flight at any time.
+# Bounding at the request level (rather than per vote) lets callers await
+# shared futures without holding a slot, which could otherwise deadlock.
+MAX_CONCURRENCY = 20
+_request_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# Global request rate, to stay polite with the Camara servers
+REQUESTS_PER_SECOND = 10
+
+class RateLimiter:
+    """
+    Token bucket shared by all requests: allows bursts up to `rate` requests
+    and refills at `rate` tokens per second.
+    """
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+_rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+
+# Response bodies keyed by URL, kept across runs so re-runs only hit the
+# network for new pages. Least-frequently-used entries are culled past the size limit.
+# Entries older than HTTP_CACHE_MAX_AGE are revalidated with a conditional GET.
+HTTP_CACHE_DIR = 'outputs/.http_cache'
+HTTP_CACHE_SIZE_LIMIT = 2 ** 30
+HTTP_CACHE_MAX_AGE = 7 * 24 * 3600
+_http_cache: Optional[diskcache.Cache] = None
+
+# Resolved memo dicts (vote -> boletin), persisted as JSON between runs
+MEMO_DIR = 'outputs/.cache'
+
+def get_http_cache() -> diskcache.Cache:
+    """
+    Opens the on-disk HTTP cache on first use.
+    """
+    global _http_cache
+    if _http_cache is None:
+        _http_cache = diskcache.Cache(
+            HTTP_CACHE_DIR,
+            size_limit=HTTP_CACHE_SIZE_LIMIT,
+            eviction_policy='least-frequently-used',
+            cull_limit=10
+        )
+    return _http_cache
+
+# Upper bound on entries per in-memory memo; least-frequently-used keys are evicted
+MEMO_MAXSIZE = 20000
+
+def memoize_async(cache: MutableMapping[str, Any], key: Callable[..., str]):
+    """
+    Memoizes a coroutine function in `cache`, keyed by `key(*args)`.
+    Concurrent callers with the same key share a single in-flight call.
+    Only non-empty results are stored, so failed lookups are retried later.
+    """
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        in_flight: Dict[str, asyncio.Future] = {}
+
+        @functools.wraps(func)
+        async def wrapper(*args: Any) -> T:
+            cache_key = key(*args)
+            if cache_key in cache:
+                return cache[cache_key]
+            if cache_key not in in_flight:
+                in_flight[cache_key] = asyncio.ensure_future(func(*args))
+            future = in_flight[cache_key]
+            try:
+                result = await future
+            finally:
+                if in_flight.get(cache_key) is future:
+                    del in_flight[cache_key]
+            if result:
+                cache[cache_key] = result
+            return result
+        return wrapper
+    return decorator
+
+def load_memo(name: str) -> Dict[str, Any]:
+    """
+    Reads the values persisted by a previous run for memo `name`.
+    """
+    path = os.path.join(MEMO_DIR, f"{name}.json")
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not load memo {path}: {e}")
+        return {}
+
+def save_memo(cache: MutableMapping[str, Any], name: str) -> None:
+    """
+    Atomically writes the entries of a memo to disk.
+    """
+    os.makedirs(MEMO_DIR, exist_ok=True)
+    path = os.path.join(MEMO_DIR, f"{name}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(dict(cache), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# Persisted memos by name, with the entries read from disk at load time
+_persisted_memos: Dict[str, LFUCache] = {}
+_loaded_memos: Dict[str, Dict[str, Any]] = {}
+
+def open_memo(name: str) -> LFUCache:
+    """
+    Creates an LFU-bounded memo that load_memos/save_memos persist as `name`.
+    """
+    cache = LFUCache(maxsize=MEMO_MAXSIZE)
+    _persisted_memos[name] = cache
+    return cache
+
+def load_memos() -> None:
+    """
+    Fills the persisted memos from previous runs. Call from main(), after setup_logging.
+    """
+    for name, cache in _persisted_memos.items():
+        loaded = load_memo(name)
+        _loaded_memos[name] = loaded
+        cache.update(loaded)
+
+def save_memos() -> None:
+    """
+    Writes back the persisted memos that gained entries in this run, merged into
+    the file on disk so runs of the other script are not overwritten.
+    """
+    for name, cache in _persisted_memos.items():
+        loaded = _loaded_memos.get(name, {})
+        new_entries = {k: v for k, v in cache.items() if loaded.get(k) != v}
+        if not new_entries:
+            continue
+        merged = load_memo(name)
+        merged.update(new_entries)
+        save_memo(merged, name)
+
+# Vote -> boletin, shared by both scripts and persisted between runs, since a
+# vote's boletin never changes (fetch_votaciones.py records it for fetch_urgencias.py).
+VOTE_TO_BOLETIN = open_memo('vote_to_boletin')
+
+def create_session() -> httpx.AsyncClient:
     """
-    Fetches content from a URL with retries and sleep.
+    Creates the shared HTTP client used by the scripts.
     """
+    # HTTP/2 multiplexes concurrent requests over one keep-alive connection per
+    # host, so there is no per-host socket limit or repeated TLS handshakes;
+    # httpx decompresses gzip/deflate bodies transparently.
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    headers = {
+        'Accept-Encoding': 'gzip, deflate',
+        'User-Agent': 'camara-cl-api scraper (+https://github.com/aoliveram/camara-cl-api)'
+    }
+    return httpx.AsyncClient(http2=True, limits=limits, timeout=10, headers=headers, follow_redirects=True)
+
+async def fetch_content(session: httpx.AsyncClient, url: str, retries: int = 3, sleep_time: float = 0.5) -> Optional[bytes]:
+    """
+    Fetches content from a URL, retrying with exponential backoff.
+    Only requests that actually go to the network are rate limited.
+    Successful responses are kept in the on-disk HTTP cache: fresh entries are
+    returned directly, stale ones are revalidated with If-None-Match/If-Modified-Since
+    and still returned if revalidation fails.
+    """
+    http_cache = get_http_cache()
+    entry = http_cache.get(url)
+    headers = {}
+    if entry is not None:
+        if time.time() - entry['fetched_at'] < HTTP_CACHE_MAX_AGE:
+            return entry['content']
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
     for attempt in range(retries):
         try:
-            time.sleep(sleep_time)
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            return response.content
-        except requests.RequestException as e:
+            async with _request_slots:
+                await _rate_limiter.acquire()
+                response = await session.get(url, headers=headers)
+            if response.status_code == 304 and entry is not None:
+                # Unchanged since last fetch: reuse the cached body
+                content = entry['content']
+            else:
+                response.raise_for_status()
+                content = response.content
+            etag = response.headers.get('ETag') or (entry or {}).get('etag')
+            last_modified = response.headers.get('Last-Modified') or (entry or {}).get('last_modified')
+            http_cache.set(url, {
+                'content': content,
+                'etag': etag,
+                'last_modified': last_modified,
+                'fetched_at': time.time()
+            })
+            return content
+        except httpx.HTTPError as e:
             logging.warning(f"Attempt {attempt + 1} failed for {url}: {e}")
-            time.sleep(sleep_time * 2)
-    
+            await asyncio.sleep(sleep_time * 2 ** attempt)
+
+    if entry is not None:
+        # Revalidation failed: a stale copy is better than treating the page as missing
+        logging.warning(f"Failed to revalidate {url} after {retries} attempts, using cached copy.")
+        return entry['content']
+
     logging.error(f"Failed to fetch {url} after {retries} attempts.")
     return None
 
-def parse_xml(content: bytes) -> Optional[ET.Element]:
+# Parsing is CPU-bound, so it runs in worker processes while network I/O
+# stays on the event loop. Workers return plain dicts/lists, never parse trees,
+# so only small payloads are pickled back.
+_parse_pool: Optional[ProcessPoolExecutor] = None
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """
+    Starts the parsing process pool on first use.
+    """
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _parse_pool
+
+def shutdown_parse_pool() -> None:
+    """
+    Stops the parsing process pool, if it was started. Call when a script ends.
     """
-    Parses XML content using lxml.
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown()
+        _parse_pool = None
+
+async def run_in_parse_pool(func: Callable[..., T], *args: Any) -> T:
+    """
+    Runs a module-level parse/extract function in the parsing process pool.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_parse_pool(), func, *args)
+
+# Vote detail XML endpoint, read by both scripts
+VOTACION_DETALLE_URL = "https://opendata.camara.cl/camaradiputados/pages/legislativo/retornarVotacionDetalle.aspx?prmID={vote_id}"
+
+async def fetch_parsed(session: httpx.AsyncClient, url: str, extractor: Callable[[bytes], T]) -> Optional[T]:
+    """
+    Fetches a page and runs `extractor` on it in the parse pool.
+    Returns None if the page could not be fetched.
+    If nothing is extracted, the cached body is dropped so the page is fetched
+    again next time instead of replaying e.g. an error page served with status 200.
+    """
+    content = await fetch_content(session, url)
+    if not content:
+        return None
+
+    result = await run_in_parse_pool(extractor, content)
+    if not result:
+        get_http_cache().delete(url)
+    return result
+
+async def fetch_votacion_fields(session: httpx.AsyncClient, vote_id: str) -> Optional[Dict[str, Any]]:
     """
+    Fetches the vote detail XML and returns its fields (see parse_votacion_fields).
+    """
+    return await fetch_parsed(session, VOTACION_DETALLE_URL.format(vote_id=vote_id), parse_votacion_fields)
+
+# Fields read from the vote detail XML (retornarVotacionDetalle.aspx)
+VOTACION_FIELDS = {'Fecha', 'Tipo', 'Resultado', 'Quorum', 'Boletin'}
+SESION_FIELDS = ('Numero', 'Fecha', 'Tipo')
+# Only these tags produce parser events; lxml does the filtering in C
+_VOTACION_TAGS = [f"{{*}}{tag}" for tag in sorted(VOTACION_FIELDS)] + ['{*}Sesion']
+# The fields and the Sesion block sit in the first few hundred bytes, ahead of the
+# Votos list, so the payload is fed in small chunks and parsing stops once they are read
+_VOTACION_CHUNK_SIZE = 2048
+
+def parse_votacion_fields(content: bytes) -> Optional[Dict[str, Any]]:
+    """
+    Incrementally parses the vote detail XML, keeping only the fields we use.
+    Returns the first occurrence (anywhere in the document) of each of VOTACION_FIELDS,
+    plus a 'Sesion' dict with the ID attribute and SESION_FIELDS of the first Sesion.
+    Tags are matched by local name, so namespaces are ignored.
+    Returns None if the payload contains no XML element at all.
+    """
+    fields: Dict[str, Any] = {}
+    sesion: Optional[Dict[str, str]] = None
+    parser = ET.XMLPullParser(events=('end',), tag=_VOTACION_TAGS, recover=True)
+    # Replace &nbsp; with space as it's not defined in standard XML
+    content = content.replace(b'&nbsp;', b' ')
     try:
-        # Replace &nbsp; with space as it's not defined in standard XML
-        cleaned_content = content.replace(b'&nbsp;', b' ')
-        # Use recover=True to handle broken XML better
-        parser = ET.XMLParser(recover=True)
-        return ET.fromstring(cleaned_content, parser=parser)
+        for offset in range(0, len(content), _VOTACION_CHUNK_SIZE):
+            parser.feed(content[offset:offset + _VOTACION_CHUNK_SIZE])
+            for _, element in parser.read_events():
+                tag = element.tag.rpartition('}')[2]
+                if tag != 'Sesion':
+                    fields.setdefault(tag, clean_text(element.text))
+                elif sesion is None:
+                    sesion = {'ID': element.get('ID', '')}
+                    for field in SESION_FIELDS:
+                        found = element.find(f".//{{*}}{field}")
+                        sesion[field] = clean_text(found.text) if found is not None else ""
+            if sesion is not None and len(fields) == len(VOTACION_FIELDS):
+                break
+        else:
+            # Some field is missing: the whole payload was read, so check it was XML at all
+            if parser.close() is None and not fields and sesion is None:
+                # e.g. a plain-text "Service unavailable" body served with status 200
+                logging.error("XML parsing error: no element found in payload")
+                return None
     except ET.XMLSyntaxError as e:
         logging.error(f"XML parsing error: {e}")
         return None
 
-def parse_html(content: bytes) -> Optional[BeautifulSoup]:
+    fields['Sesion'] = sesion
+    return fields
+
+def parse_html_lxml(content: bytes) -> Optional[lxml.html.HtmlElement]:
     """
-    Parses HTML content using BeautifulSoup.
+    Parses HTML content directly with lxml, for XPath-based extraction.
     """
     try:
-        return BeautifulSoup(content, 'lxml')
-    except Exception as e:
+        return lxml.html.fromstring(content)
+    except (ET.ParserError, ValueError) as e:
         logging.error(f"HTML parsing error: {e}")
         return None
 
 def clean_text(text: Optional[str]) -> str:
     """
     Cleans whitespace from text.
+    Already-clean text (the common case for table cells) is returned without rebuilding it.
+    """
+    if not text:
+        return ""
+    if ('  ' not in text and '\n' not in text and '\t' not in text and '\r' not in text
+            and '\xa0' not in text and text[0] != ' ' and text[-1] != ' '):
+        return text
+    return " ".join(text.split())
+
+def check_csv_header(path: str, fieldnames: List[str]) -> bool:
+    """
+    Checks that an existing output CSV has exactly `fieldnames` as its header,
+    so rows are never appended under different columns. Missing or empty files pass.
+    """
+    if not os.path.exists(path):
+        return True
+
+    with open(path, newline='', encoding='utf-8') as f:
+        header = next(csv.reader(f), None)
+    if header is None or header == fieldnames:
+        return True
+
+    logging.error(f"{path} has columns {header}, expected {fieldnames}; not appending to it.")
+    return False
+
+def load_processed_ids(path: str, column: str = 'vote_id') -> Set[str]:
+    """
+    Reads the IDs already written to an output CSV, so a re-run can skip them.
+    """
+    if not os.path.exists(path):
+        return set()
+
+    with open(path, newline='', encoding='utf-8') as f:
+        return {row[column] for row in csv.DictReader(f) if row.get(column)}
+
+@contextmanager
+def open_csv_appender(path: str, fieldnames: List[str]) -> Iterator[Callable[[Iterable[Dict[str, Any]]], None]]:
+    """
+    Opens a CSV for appending and yields a function that writes and flushes rows.
+    The header is only written when the file is new or empty. Rows end in '\n',
+    like the files pandas writes, so appended rows keep the file's line endings.
     """
-    if text:
-        return " ".join(text.split())
-    return ""
+    with open(path, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, lineterminator='\n')
+        if f.tell() == 0:
+            writer.writeheader()
+
+        def append_rows(rows: Iterable[Dict[str, Any]]) -> None:
+            writer.writerows(rows)
+            f.flush()
+
+        yield append_rows